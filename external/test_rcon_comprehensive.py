@@ -3,11 +3,14 @@
 Comprehensive RCON Test Suite
 Tests all aspects of RCON functionality including edge cases.
 """
+import os
 import socket
 import struct
 import sys
 import time
 import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # RCON Packet Types
 SERVERDATA_AUTH = 3
@@ -15,96 +18,256 @@ SERVERDATA_AUTH_RESPONSE = 2
 SERVERDATA_EXECCOMMAND = 2
 SERVERDATA_RESPONSE_VALUE = 0
 
-def send_rcon_packet(sock, packet_id, packet_type, body):
-    """Send an RCON packet"""
-    body_bytes = body.encode('utf-8')
+# Precompiled packet layouts: size/id/type header and a single uint32
+_HDR_STRUCT = struct.Struct('<III')
+_U32_STRUCT = struct.Struct('<I')
+
+# Empty-string body terminator plus the trailing packet padding byte
+_TERMINATOR = b'\x00\x00'
+
+MAX_PACKET_SIZE = 4096
+READ_TIMEOUT = 5
+
+# Ask the kernel to wait for the full read where that is reliable
+_RECV_FLAGS = socket.MSG_WAITALL if hasattr(socket, 'MSG_WAITALL') and sys.platform != 'win32' else 0
+
+def pack_packet_into(buf, offset, packet_id, packet_type, body_bytes):
+    """Encode an RCON packet into buf at offset, returning the offset past it"""
     packet_size = 4 + 4 + len(body_bytes) + 1 + 1
-    packet = struct.pack('<III', packet_size, packet_id, packet_type)
-    packet += body_bytes
-    packet += b'\x00'
-    packet += b'\x00'
-    sock.sendall(packet)
+    _HDR_STRUCT.pack_into(buf, offset, packet_size, packet_id, packet_type)
+    body_end = offset + 12 + len(body_bytes)
+    buf[offset + 12:body_end] = body_bytes
+    # Written explicitly so reused buffers don't leak stale bytes
+    buf[body_end:body_end + 2] = _TERMINATOR
+    return body_end + 2
+
+def pack_packet(packet_id, packet_type, body_bytes):
+    """Encode an RCON packet, including its size prefix"""
+    packet = bytearray(14 + len(body_bytes))
+    pack_packet_into(packet, 0, packet_id, packet_type, body_bytes)
     return packet
 
-def read_rcon_packet(sock, timeout=5):
-    """Read an RCON packet from the socket"""
-    sock.settimeout(timeout)
-    size_data = sock.recv(4)
-    if len(size_data) < 4:
-        raise Exception("Connection closed while reading size")
+def pack_auth(packet_id, password_bytes):
+    """Encode a SERVERDATA_AUTH packet"""
+    header = _HDR_STRUCT.pack(4 + 4 + len(password_bytes) + 1 + 1, packet_id, SERVERDATA_AUTH)
+    return header + password_bytes + _TERMINATOR
+
+def parse_packet(packet_data, packet_end=None):
+    """Decode the RCON packet in packet_data[:packet_end] into (id, type, body_bytes)"""
+    if packet_end is None:
+        packet_end = len(packet_data)
+    _, packet_id, packet_type = _HDR_STRUCT.unpack_from(packet_data, 0)
+    
+    # Find null terminator to extract body correctly, searching in place
+    body_start = 12
+    body_end = packet_data.find(0, body_start, packet_end - 1)
+    if body_end == -1:
+        body_end = packet_end - 1
+    
+    return packet_id, packet_type, packet_data[body_start:body_end]
+
+def decode_body(body_bytes, strip=True):
+    """Decode a packet body, trimming whitespace before decoding when asked"""
+    if strip:
+        body_bytes = body_bytes.strip()
+    return body_bytes.decode('utf-8', errors='ignore')
+
+def send_rcon_packet(sock, packet_id, packet_type, body):
+    """Send an RCON packet"""
+    sock.sendall(pack_packet(packet_id, packet_type, body.encode('utf-8')))
+
+def recv_exact(sock, buf, n):
+    """Receive exactly n bytes from the socket into the start of buf"""
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:n], n - received, _RECV_FLAGS)
+        if not count:
+            raise ConnectionError(f"Connection closed: expected {n} bytes, got {received}")
+        received += count
+
+def read_rcon_packet(sock, timeout=None, buf=None):
+    """Read an RCON packet from the socket, optionally into a reusable buffer"""
+    # settimeout is a syscall; only pay for it when the timeout changes
+    if timeout is not None and sock.gettimeout() != timeout:
+        sock.settimeout(timeout)
+    if buf is None:
+        buf = bytearray(4 + MAX_PACKET_SIZE)
+    recv_exact(sock, buf, 4)
     
-    packet_size = struct.unpack('<I', size_data)[0]
-    if packet_size < 10 or packet_size > 4096:
+    packet_size = _U32_STRUCT.unpack_from(buf, 0)[0]
+    if packet_size < 10 or packet_size > MAX_PACKET_SIZE:
         raise Exception(f"Invalid packet size: {packet_size}")
     
-    remaining = sock.recv(packet_size)
-    if len(remaining) < packet_size:
-        raise Exception(f"Connection closed: expected {packet_size} bytes, got {len(remaining)}")
+    recv_exact(sock, memoryview(buf)[4:], packet_size)
+    
+    return parse_packet(buf, 4 + packet_size)
+
+class RconConn:
+    """An RCON socket paired with send and receive buffers reused for every packet"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_buf = bytearray(4 + MAX_PACKET_SIZE)
+        self.send_view = memoryview(self.send_buf)
+        self.recv_buf = bytearray(4 + MAX_PACKET_SIZE)
     
-    packet_data = size_data + remaining
-    packet_id = struct.unpack('<I', packet_data[4:8])[0]
-    packet_type = struct.unpack('<I', packet_data[8:12])[0]
+    def send_packet(self, packet_id, packet_type, body):
+        """Send an RCON packet, encoding it into the connection's send buffer"""
+        body_bytes = body.encode('utf-8')
+        if 14 + len(body_bytes) > len(self.send_buf):
+            # Oversized packets (which the server rejects) bypass the buffer
+            send_rcon_packet(self.sock, packet_id, packet_type, body)
+            return
+        end = pack_packet_into(self.send_buf, 0, packet_id, packet_type, body_bytes)
+        self.sock.sendall(self.send_view[:end])
     
-    # Find null terminator to extract body correctly
-    body_start = 12
-    body_end = body_start
-    for i in range(body_start, len(packet_data) - 1):
-        if packet_data[i] == 0:
-            body_end = i
-            break
+    def read_packet(self, timeout=None):
+        """Read an RCON packet into the connection's receive buffer"""
+        return read_rcon_packet(self.sock, timeout, self.recv_buf)
     
-    body_bytes = packet_data[body_start:body_end]
-    body = body_bytes.decode('utf-8', errors='ignore')
+    def execute(self, command, request_id=101):
+        """Execute a command and return response"""
+        self.send_packet(request_id, SERVERDATA_EXECCOMMAND, command)
+        cmd_id, cmd_type, cmd_body = self.read_packet()
+        
+        return decode_body(cmd_body, cmd_id == request_id and cmd_type == SERVERDATA_RESPONSE_VALUE)
     
-    return packet_id, packet_type, body
+    def close(self):
+        """Close the underlying socket"""
+        self.sock.close()
 
 def connect_and_auth(host='127.0.0.1', port=25575, password='hello'):
-    """Connect and authenticate"""
+    """Connect and authenticate, returning an RconConn"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Small request/response packets: don't let Nagle hold them back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     sock.settimeout(10)
     sock.connect((host, port))
-    time.sleep(0.1)  # Small delay for connection to stabilize
+    sock.settimeout(READ_TIMEOUT)
+    conn = RconConn(sock)
     
-    send_rcon_packet(sock, 100, SERVERDATA_AUTH, password)
-    auth_id, auth_type, auth_body = read_rcon_packet(sock)
+    sock.sendall(pack_auth(100, password.encode('utf-8')))
+    auth_id, auth_type, auth_body = conn.read_packet()
     
     if auth_type != SERVERDATA_AUTH_RESPONSE:
-        sock.close()
+        conn.close()
         raise Exception(f"Authentication failed: type={auth_type}")
     
-    return sock
+    return conn
+
+def connect_with_retry(timeout=1.0, delay=0.02):
+    """Connect and authenticate, polling briefly while the server releases a slot"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return connect_and_auth()
+        except ConnectionError:
+            # Refused, reset, or closed on accept when over maxConnections;
+            # timeouts and auth rejections are not retried
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(delay)
 
-def execute_command(sock, command, request_id=101):
+def execute_command(conn, command, request_id=101):
     """Execute a command and return response"""
-    send_rcon_packet(sock, request_id, SERVERDATA_EXECCOMMAND, command)
-    cmd_id, cmd_type, cmd_body = read_rcon_packet(sock)
+    return conn.execute(command, request_id)
+
+def execute_batch(conn, commands, first_request_id=101):
+    """Pipeline several commands and return their responses keyed by request id"""
+    encoded = [command.encode('utf-8') for command in commands]
+    # All packets go out in one buffer and one sendall
+    packets = bytearray(sum(14 + len(body_bytes) for body_bytes in encoded))
+    offset = 0
+    for request_id, body_bytes in enumerate(encoded, first_request_id):
+        offset = pack_packet_into(packets, offset, request_id, SERVERDATA_EXECCOMMAND, body_bytes)
+    conn.sock.sendall(packets)
     
-    if cmd_id == request_id and cmd_type == SERVERDATA_RESPONSE_VALUE:
-        return cmd_body.rstrip('\x00').strip()
-    return cmd_body
+    responses = {}
+    for _ in commands:
+        cmd_id, cmd_type, cmd_body = conn.read_packet()
+        responses[cmd_id] = decode_body(cmd_body, cmd_type == SERVERDATA_RESPONSE_VALUE)
+    return responses
 
 class TestRunner:
     def __init__(self):
         self.passed = 0
         self.failed = 0
         self.tests = []
+        # One authenticated connection shared by every test, opened on first use
+        self.conn = None
+    
+    def record(self, result, error=None):
+        """Record and print the outcome of a test"""
+        if error is not None:
+            print(f"  ✗ FAILED: {error}")
+            self.failed += 1
+            if os.environ.get('RCON_DEBUG'):
+                traceback.print_exception(type(error), error, error.__traceback__)
+        elif result:
+            print(f"  ✓ PASSED")
+            self.passed += 1
+        else:
+            print(f"  ✗ FAILED")
+            self.failed += 1
     
     def test(self, name, func):
-        """Run a test"""
+        """Run a test against the shared connection"""
         print(f"\n[TEST] {name}")
         try:
-            result = func()
-            if result:
-                print(f"  ✓ PASSED")
-                self.passed += 1
-            else:
-                print(f"  ✗ FAILED")
-                self.failed += 1
+            if self.conn is None:
+                self.conn = connect_and_auth()
+            result = func(self.conn)
         except Exception as e:
-            print(f"  ✗ FAILED: {e}")
-            self.failed += 1
-            import traceback
-            traceback.print_exc()
+            self.record(False, e)
+            # A failed exchange may leave unread data behind; start fresh
+            self.reconnect()
+        else:
+            self.record(result)
+    
+    def reconnect(self):
+        """Replace the shared connection, leaving it unset if the server is unreachable"""
+        self.close()
+        try:
+            self.conn = connect_with_retry()
+        except Exception as e:
+            print(f"  Reconnect failed: {e}")
+    
+    def run_parallel(self, tests, max_workers=4):
+        """Run independent tests concurrently, one connection per worker thread"""
+        local = threading.local()
+        conns = []
+        lock = threading.Lock()
+        
+        def run(func):
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                conn = local.conn = connect_and_auth()
+                with lock:
+                    conns.append(conn)
+            try:
+                return func(conn)
+            except Exception:
+                # Don't reuse a connection that may hold unread data
+                conn.close()
+                local.conn = None
+                raise
+        
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(run, func): name for name, func in tests}
+                for future in as_completed(futures):
+                    error = future.exception()
+                    print(f"\n[TEST] {futures[future]}")
+                    self.record(error is None and future.result(), error)
+        finally:
+            for conn in conns:
+                conn.close()
+    
+    def close(self):
+        """Close the shared connection"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
     
     def summary(self):
         """Print test summary"""
@@ -113,135 +276,80 @@ class TestRunner:
         print(f"Test Summary: {self.passed}/{total} passed, {self.failed} failed")
         print("="*60)
 
-def test_basic_echo():
+def test_basic_echo(conn):
     """Test basic echo command"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "echo hello world", 200)
-        return response == "hello world"
-    finally:
-        sock.close()
-        time.sleep(0.2)
-
-def test_empty_command():
+    response = execute_command(conn, "echo hello world", 200)
+    return response == "hello world"
+
+def test_empty_command(conn):
     """Test empty command"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "", 201)
-        return response == "" or len(response) == 0
-    finally:
-        sock.close()
-
-def test_special_characters():
+    response = execute_command(conn, "", 201)
+    return response == "" or len(response) == 0
+
+def test_special_characters(conn):
     """Test commands with special characters"""
-    sock = connect_and_auth()
-    try:
-        test_str = "!@#$%^&*()_+-=[]{}|;':\",./<>?"
-        response = execute_command(sock, f"echo {test_str}", 202)
-        return test_str in response
-    finally:
-        sock.close()
-
-def test_unicode_characters():
+    test_str = "!@#$%^&*()_+-=[]{}|;':\",./<>?"
+    response = execute_command(conn, f"echo {test_str}", 202)
+    return test_str in response
+
+def test_unicode_characters(conn):
     """Test commands with unicode"""
-    sock = connect_and_auth()
-    try:
-        test_str = "Hello 世界 🌍"
-        response = execute_command(sock, f"echo {test_str}", 203)
-        return test_str in response
-    finally:
-        sock.close()
-
-def test_long_command():
+    test_str = "Hello 世界 🌍"
+    response = execute_command(conn, f"echo {test_str}", 203)
+    return test_str in response
+
+def test_long_command(conn):
     """Test long command"""
-    sock = connect_and_auth()
-    try:
-        long_str = "A" * 500
-        response = execute_command(sock, f"echo {long_str}", 204)
-        return long_str in response
-    finally:
-        sock.close()
-
-def test_multiple_commands():
-    """Test multiple commands in sequence"""
-    sock = connect_and_auth()
-    try:
-        results = []
-        for i in range(5):  # Reduced from 10 to avoid issues
-            response = execute_command(sock, f"echo test{i}", 300 + i)
-            results.append(f"test{i}" in response)
-            time.sleep(0.2)  # Increased delay
-        return all(results)
-    finally:
-        sock.close()
-        time.sleep(0.3)  # Delay before next test
-
-def test_hytale_version():
+    long_str = "A" * 500
+    response = execute_command(conn, f"echo {long_str}", 204)
+    return long_str in response
+
+def test_multiple_commands(conn):
+    """Test multiple pipelined commands on one connection"""
+    responses = execute_batch(conn, [f"echo test{i}" for i in range(5)], 300)
+    return all(f"test{i}" in responses.get(300 + i, "") for i in range(5))
+
+def test_hytale_version(conn):
     """Test Hytale version command"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "version", 400)
-        return "HytaleServer" in response or "v" in response
-    finally:
-        sock.close()
-
-def test_hytale_who():
+    response = execute_command(conn, "version", 400)
+    return "HytaleServer" in response or "v" in response
+
+def test_hytale_who(conn):
     """Test Hytale who command"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "who", 401)
-        return isinstance(response, str) and len(response) >= 0
-    finally:
-        sock.close()
-
-def test_hytale_help():
+    response = execute_command(conn, "who", 401)
+    return isinstance(response, str) and len(response) >= 0
+
+def test_hytale_help(conn):
     """Test Hytale help command"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "help", 402)
-        return isinstance(response, str)
-    finally:
-        sock.close()
-
-def test_hytale_commands_list():
+    response = execute_command(conn, "help", 402)
+    return isinstance(response, str)
+
+def test_hytale_commands_list(conn):
     """Test Hytale commands command"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "commands", 403)
-        return isinstance(response, str)
-    finally:
-        sock.close()
-
-def test_invalid_command():
+    response = execute_command(conn, "commands", 403)
+    return isinstance(response, str)
+
+def test_invalid_command(conn):
     """Test invalid/non-existent command"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "nonexistentcommand12345", 404)
-        # Should return error message or empty, not crash
-        return isinstance(response, str)
-    finally:
-        sock.close()
-
-def test_command_with_args():
+    response = execute_command(conn, "nonexistentcommand12345", 404)
+    # Should return error message or empty, not crash
+    return isinstance(response, str)
+
+def test_command_with_args(conn):
     """Test command with arguments"""
-    sock = connect_and_auth()
-    try:
-        response = execute_command(sock, "echo arg1 arg2 arg3", 405)
-        return "arg1 arg2 arg3" in response or "arg1" in response
-    finally:
-        sock.close()
-
-def test_concurrent_connections():
-    """Test multiple concurrent connections"""
+    response = execute_command(conn, "echo arg1 arg2 arg3", 405)
+    return "arg1 arg2 arg3" in response or "arg1" in response
+
+def test_concurrent_connections(_conn):
+    """Test multiple concurrent connections, each on its own socket"""
     results = []
     lock = threading.Lock()
     
     def run_connection(conn_id):
         try:
-            time.sleep(conn_id * 0.1)  # Stagger connections
-            sock = connect_and_auth()
-            response = execute_command(sock, f"echo concurrent{conn_id}", 500 + conn_id)
-            sock.close()
+            conn = connect_and_auth()
+            response = execute_command(conn, f"echo concurrent{conn_id}", 500 + conn_id)
+            conn.close()
             with lock:
                 results.append(f"concurrent{conn_id}" in response)
         except Exception as e:
@@ -258,50 +366,38 @@ def test_concurrent_connections():
     for t in threads:
         t.join(timeout=15)
     
-    time.sleep(0.5)  # Wait for connections to close
     return all(results) and len(results) == 3
 
-def test_reconnection():
-    """Test reconnecting after disconnect"""
+def test_reconnection(_conn):
+    """Test reconnecting after disconnect, on fresh sockets"""
     # First connection
-    sock1 = connect_and_auth()
-    execute_command(sock1, "echo first", 600)
-    sock1.close()
+    conn1 = connect_and_auth()
+    execute_command(conn1, "echo first", 600)
+    conn1.close()
     
-    time.sleep(1.0)  # Increased delay for connection cleanup
-    
-    # Second connection
-    sock2 = connect_and_auth()
-    response = execute_command(sock2, "echo second", 601)
-    sock2.close()
-    time.sleep(0.3)
+    # Second connection, once the server has released the first
+    conn2 = connect_with_retry()
+    response = execute_command(conn2, "echo second", 601)
+    conn2.close()
     
     return "second" in response
 
-def test_large_response():
+def test_large_response(conn):
     """Test command that returns large response"""
-    sock = connect_and_auth()
-    try:
-        # Use a command that should return some data
-        # Try multiple commands to find one that returns data
-        response1 = execute_command(sock, "commands", 700)
-        response2 = execute_command(sock, "version", 701)
-        # At least one should return data
-        return isinstance(response1, str) and isinstance(response2, str) and (len(response1) > 0 or len(response2) > 0)
-    finally:
-        sock.close()
-
-def test_command_timeout():
+    # Use a command that should return some data
+    # Try multiple commands to find one that returns data
+    response1 = execute_command(conn, "commands", 700)
+    response2 = execute_command(conn, "version", 701)
+    # At least one should return data
+    return isinstance(response1, str) and isinstance(response2, str) and (len(response1) > 0 or len(response2) > 0)
+
+def test_command_timeout(conn):
     """Test that commands don't hang indefinitely"""
-    sock = connect_and_auth()
-    try:
-        start = time.time()
-        response = execute_command(sock, "version", 800)
-        elapsed = time.time() - start
-        # Should complete in reasonable time (< 5 seconds)
-        return elapsed < 5.0 and isinstance(response, str)
-    finally:
-        sock.close()
+    start = time.time()
+    response = execute_command(conn, "version", 800)
+    elapsed = time.time() - start
+    # Should complete in reasonable time (< 5 seconds)
+    return elapsed < 5.0 and isinstance(response, str)
 
 def main():
     """Run all tests"""
@@ -315,48 +411,38 @@ def main():
     print("\n" + "="*60)
     print("Basic Functionality Tests")
     print("="*60)
-    runner.test("Basic echo command", test_basic_echo)
-    time.sleep(0.3)
-    runner.test("Empty command", test_empty_command)
-    time.sleep(0.3)
-    runner.test("Special characters", test_special_characters)
-    time.sleep(0.3)
-    runner.test("Unicode characters", test_unicode_characters)
-    time.sleep(0.3)
-    runner.test("Long command", test_long_command)
-    time.sleep(0.3)
-    runner.test("Command with arguments", test_command_with_args)
-    time.sleep(0.3)
+    runner.run_parallel([
+        ("Basic echo command", test_basic_echo),
+        ("Empty command", test_empty_command),
+        ("Special characters", test_special_characters),
+        ("Unicode characters", test_unicode_characters),
+        ("Long command", test_long_command),
+        ("Command with arguments", test_command_with_args),
+    ])
     
     # Hytale integration tests
     print("\n" + "="*60)
     print("Hytale Integration Tests")
     print("="*60)
-    runner.test("Hytale version command", test_hytale_version)
-    time.sleep(0.3)
-    runner.test("Hytale who command", test_hytale_who)
-    time.sleep(0.3)
-    runner.test("Hytale help command", test_hytale_help)
-    time.sleep(0.3)
-    runner.test("Hytale commands list", test_hytale_commands_list)
-    time.sleep(0.3)
-    runner.test("Invalid command handling", test_invalid_command)
-    time.sleep(0.3)
+    runner.run_parallel([
+        ("Hytale version command", test_hytale_version),
+        ("Hytale who command", test_hytale_who),
+        ("Hytale help command", test_hytale_help),
+        ("Hytale commands list", test_hytale_commands_list),
+        ("Invalid command handling", test_invalid_command),
+    ])
     
     # Advanced tests
     print("\n" + "="*60)
     print("Advanced Tests")
     print("="*60)
-    runner.test("Multiple commands in sequence", test_multiple_commands)
-    time.sleep(0.5)
+    runner.test("Multiple pipelined commands", test_multiple_commands)
     runner.test("Concurrent connections", test_concurrent_connections)
-    time.sleep(1.0)
     runner.test("Reconnection after disconnect", test_reconnection)
-    time.sleep(0.5)
     runner.test("Large response handling", test_large_response)
-    time.sleep(0.3)
     runner.test("Command timeout handling", test_command_timeout)
     
+    runner.close()
     runner.summary()
     
     if runner.failed > 0: